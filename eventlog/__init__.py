@@ -5,6 +5,7 @@ try:
     from models import create_event
     from models import log_debug, log_info, log_event, log_warning, log_error, log_fatal, log_critical
     from models import log_exception
+    from models import start_collecting, flush_events
 except:
     pass
     
\ No newline at end of file
@@ -0,0 +1,268 @@
+"""Archive old events into compressed segment files and read them back.
+
+Events are archived per month. Each archive file holds the events of one month in segments of a fixed number of
+events, and later runs add new segments to the file of their month. Every segment is a zlib compressed JSON list. After the segments comes the index of the file, a JSON list with
+one entry per segment::
+
+  {"offset": 0, "length": 1234, "count": 1000, "start": "...", "end": "...",
+   "labels": ["USER_LOGIN", ...], "levels": {"20": 990, "30": 10}}
+
+and the file ends with the offset of the index as an 8 byte big endian integer. Readers only need to read the index to
+find out which segments they have to decompress.
+"""
+import json
+import os
+import struct
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.dateparse import parse_datetime
+
+from eventlog.models import Event
+
+
+SEGMENT_SIZE = 1000
+# number of ids per query, below the limit of 999 variables of some SQLite builds
+CHUNK_SIZE = 500
+TRAILER = struct.Struct(">Q")
+SUFFIX = ".archive"
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _serialize(event):
+    return {
+        'id': event.id,
+        'user_id': event.user_id,
+        'level': event.level,
+        'label': event.label,
+        'message': event.message,
+        'timestamp': event.timestamp.isoformat(),
+        'extra': event.extra,
+    }
+
+
+def _deserialize(data, users):
+    data = dict(data)
+    data['timestamp'] = parse_datetime(data['timestamp'])
+    # like in the database, events of users that have been deleted since don't have a user any more
+    data['user'] = users.get(data.pop('user_id'))
+    return Event(**data)
+
+
+def _get_users(user_ids):
+    user_ids = list(user_ids)
+    users = {}
+    for i in range(0, len(user_ids), CHUNK_SIZE):
+        users.update(User.objects.in_bulk(user_ids[i:i + CHUNK_SIZE]))
+    return users
+
+
+def _month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(timestamp):
+    if timestamp.month == 12:
+        return timestamp.replace(year=timestamp.year + 1, month=1)
+    return timestamp.replace(month=timestamp.month + 1)
+
+
+def archive_directory():
+    """Return the directory archive files are kept in, set by the EVENTLOG_ARCHIVE_DIR setting."""
+    return getattr(settings, "EVENTLOG_ARCHIVE_DIR", "eventlog_archive")
+
+
+def write_archive_file(path, events, segment_size=SEGMENT_SIZE):
+    """Write the given events, oldest first, into the archive file at path.
+
+    If the file exists, the events are added to it as new segments. The file is written under a temporary name and
+    moved into place when it is complete, so it is never left half written. If writing fails, the temporary file is
+    removed. Returns the list of ids of the written events.
+    """
+    ids = []
+    index = []
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            if os.path.exists(path):
+                # copy the segments of the existing file, the new ones go after them, followed by the combined index
+                index, index_offset = _read_raw_index(path)
+                with open(path, "rb") as existing:
+                    remaining = index_offset
+                    while remaining:
+                        data = existing.read(min(remaining, COPY_BUFFER_SIZE))
+                        if not data:
+                            raise IOError("archive file {0} is truncated".format(path))
+                        f.write(data)
+                        remaining -= len(data)
+
+            def write_segment(segment):
+                data = zlib.compress(json.dumps([_serialize(event) for event in segment]).encode("utf-8"))
+                levels = {}
+                for event in segment:
+                    levels[str(event.level)] = levels.get(str(event.level), 0) + 1
+                index.append({
+                    'offset': f.tell(),
+                    'length': len(data),
+                    'count': len(segment),
+                    'start': segment[0].timestamp.isoformat(),
+                    'end': segment[-1].timestamp.isoformat(),
+                    'labels': sorted(set(event.label for event in segment)),
+                    'levels': levels,
+                })
+                f.write(data)
+
+            segment = []
+            for event in events:
+                ids.append(event.id)
+                segment.append(event)
+                if len(segment) >= segment_size:
+                    write_segment(segment)
+                    segment = []
+            if segment:
+                write_segment(segment)
+
+            index_offset = f.tell()
+            f.write(json.dumps(index).encode("utf-8"))
+            f.write(TRAILER.pack(index_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        if ids:
+            os.rename(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return ids
+
+
+def _read_raw_index(path):
+    # return the index of the archive file at path as it is stored, and its offset
+    with open(path, "rb") as f:
+        f.seek(-TRAILER.size, os.SEEK_END)
+        end = f.tell()
+        index_offset, = TRAILER.unpack(f.read(TRAILER.size))
+        f.seek(index_offset)
+        return json.loads(f.read(end - index_offset).decode("utf-8")), index_offset
+
+
+def read_index(path):
+    """Return the segment index of the archive file at path, with `start` and `end` parsed to datetimes."""
+    index, index_offset = _read_raw_index(path)
+    for segment in index:
+        segment['start'] = parse_datetime(segment['start'])
+        segment['end'] = parse_datetime(segment['end'])
+        segment['levels'] = dict((int(level), count) for level, count in segment['levels'].items())
+    return index
+
+
+def _read_segments(path, start=None, end=None, labels=None):
+    # yield the serialized events of the segments that may contain matching events, as lists
+    with open(path, "rb") as f:
+        for segment in read_index(path):
+            if start is not None and segment['end'] < start:
+                continue
+            if end is not None and segment['start'] >= end:
+                continue
+            if labels is not None and labels.isdisjoint(segment['labels']):
+                continue
+
+            f.seek(segment['offset'])
+            yield json.loads(zlib.decompress(f.read(segment['length'])).decode("utf-8"))
+
+
+def read_archive_file(path, start=None, end=None, labels=None):
+    """Yield the events in the archive file at path with start <= timestamp < end and a label in labels.
+
+    Segments that can't contain matching events according to the index are skipped without being read.
+    Events are returned as unsaved `Event` instances. If the user of an event has been deleted in the meantime, the
+    event's user is None.
+    """
+    if labels is not None:
+        labels = set(labels)
+    for segment in _read_segments(path, start, end, labels):
+        users = _get_users(set(data['user_id'] for data in segment if data['user_id'] is not None))
+        for data in segment:
+            event = _deserialize(data, users)
+            if start is not None and event.timestamp < start:
+                continue
+            if end is not None and event.timestamp >= end:
+                continue
+            if labels is not None and event.label not in labels:
+                continue
+            yield event
+
+
+def read_archive(start=None, end=None, labels=None, directory=None):
+    """Yield the archived events with start <= timestamp < end and a label in labels.
+
+    All archive files in directory (the archive directory by default) are searched, oldest month first.
+    """
+    directory = directory or archive_directory()
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        for event in read_archive_file(path, start, end, labels):
+            yield event
+
+
+def _delete_events(ids):
+    for i in range(0, len(ids), CHUNK_SIZE):
+        Event.objects.filter(id__in=ids[i:i + CHUNK_SIZE]).delete()
+
+
+def _archive_path(directory, month):
+    return os.path.join(directory, "events-{0:%Y-%m}{1}".format(month, SUFFIX))
+
+
+def archive_events(before, directory=None, segment_size=SEGMENT_SIZE):
+    """Move all events older than before from the database into archive files, one file per month.
+
+    If a month has been archived before, its events are added to the existing file. Events are deleted from the
+    database in chunks, and only once their file has been written. Events that are already in the archive file,
+    because an earlier run failed to delete them, are only deleted and not archived again.
+    Returns a list of (path, number of events) for the files written.
+    """
+    directory = directory or archive_directory()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    written = []
+    old_events = Event.objects.filter(timestamp__lt=before)
+    while True:
+        try:
+            first = old_events.order_by("timestamp", "id")[0]
+        except IndexError:
+            break
+        month = _month_start(first.timestamp)
+        next_month = _next_month(month)
+
+        # events left over from an earlier run are at least as new as the oldest event left in the database, so the
+        # index lets us skip most of the existing file
+        path = _archive_path(directory, month)
+        archived = set()
+        if os.path.exists(path):
+            for segment in _read_segments(path, start=first.timestamp):
+                archived.update(data['id'] for data in segment)
+
+        already_archived = []
+        def new_events(events):
+            for event in events:
+                if event.id in archived:
+                    already_archived.append(event.id)
+                else:
+                    yield event
+
+        events = old_events.filter(timestamp__gte=month, timestamp__lt=next_month).order_by("timestamp", "id")
+        ids = write_archive_file(path, new_events(events.iterator()), segment_size)
+        if ids:
+            written.append((path, len(ids)))
+        _delete_events(already_archived + ids)
+
+    return written
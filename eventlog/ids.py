@@ -0,0 +1,112 @@
+"""Time-ordered 64 bit event IDs, generated in Python.
+
+An ID is laid out like a snowflake ID:
+
+  - 41 bits: milliseconds since ``EPOCH``
+  - 10 bits: node id (0-1023)
+  - 12 bits: per-millisecond sequence number
+
+so it fits into a signed 64 bit integer column and IDs sort by creation time.
+
+Every process that generates IDs needs its own node id, given by the ``EVENTLOG_NODE_ID`` setting. Processes that share
+a node id can generate the same ID.
+"""
+import calendar
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+TIMESTAMP_BITS = 41
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+NODE_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + NODE_BITS
+
+# 2013-01-01 00:00:00 UTC in milliseconds since the unix epoch
+EPOCH = 1356998400000
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class IdGenerator(object):
+    """Thread safe generator for time-ordered IDs on a single node."""
+
+    def __init__(self, node, clock=_now_ms):
+        if not 0 <= node <= MAX_NODE:
+            raise ValueError("node must be between 0 and {0}".format(MAX_NODE))
+        self.node = node
+        self.clock = clock
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            now = self.clock()
+            if now < self.last_ms:
+                # the clock went backwards; keep counting on the last timestamp so we stay ordered
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # sequence exhausted for this millisecond, wait for the next one
+                    while now <= self.last_ms:
+                        time.sleep(0.0001)
+                        now = self.clock()
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return ((now - EPOCH) << TIMESTAMP_SHIFT) | (self.node << NODE_SHIFT) | self.sequence
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def node_id():
+    """Return the node id from the EVENTLOG_NODE_ID setting, or raise ImproperlyConfigured if it is not set."""
+    node = getattr(settings, "EVENTLOG_NODE_ID", None)
+    if node is None:
+        raise ImproperlyConfigured("Time-ordered event IDs need EVENTLOG_NODE_ID to be set to a number from 0 to {0} "
+                                   "that is different for every process writing events".format(MAX_NODE))
+    return node
+
+
+def generate_id():
+    """Return a new time-ordered ID. This is used as the default for `Event.id` if time-ordered IDs are enabled."""
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = IdGenerator(node_id())
+    return _generator.next_id()
+
+
+def id_to_datetime(event_id):
+    """Return the (naive, UTC) datetime encoded in the given ID, with millisecond precision."""
+    return datetime(1970, 1, 1) + timedelta(milliseconds=(event_id >> TIMESTAMP_SHIFT) + EPOCH)
+
+
+def datetime_to_id(dt):
+    """Return the smallest ID that can be generated at the given datetime.
+
+    Use this to filter on the primary key instead of the timestamp, e.g.
+    ``Event.objects.filter(id__gte=datetime_to_id(start), id__lt=datetime_to_id(end))``.
+    Naive datetimes are taken to be UTC.
+    """
+    if dt.tzinfo is not None:
+        seconds = calendar.timegm(dt.utctimetuple())
+    else:
+        seconds = calendar.timegm(dt.timetuple())
+    ms = seconds * 1000 + dt.microsecond // 1000
+    return max(ms - EPOCH, 0) << TIMESTAMP_SHIFT
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from eventlog.archive import archive_events, SEGMENT_SIZE
+
+
+class Command(BaseCommand):
+    help = "Move old events from the database into compressed archive files."
+    
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", default=30,
+            help="Archive events older than this many days (default: 30)"),
+        make_option("--before",
+            help="Archive events older than this date (YYYY-MM-DD), instead of using --days"),
+        make_option("--directory",
+            help="Directory to write the archive files to (default: the EVENTLOG_ARCHIVE_DIR setting)"),
+        make_option("--segment-size", dest="segment_size", type="int", default=SEGMENT_SIZE,
+            help="Number of events per segment (default: {0})".format(SEGMENT_SIZE)),
+    )
+    
+    def handle(self, *args, **options):
+        if options.get("before"):
+            try:
+                before = datetime.strptime(options["before"], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--before must be a date in the format YYYY-MM-DD")
+            if settings.USE_TZ:
+                before = timezone.make_aware(before, timezone.get_current_timezone())
+        else:
+            before = timezone.now() - timedelta(days=options["days"])
+        
+        written = archive_events(before, directory=options.get("directory"), segment_size=options["segment_size"])
+        for path, count in written:
+            self.stdout.write("Archived {0} events to {1}\n".format(count, path))
+        if not written:
+            self.stdout.write("No events older than {0} to archive\n".format(before))
@@ -0,0 +1,17 @@
+from eventlog.models import start_collecting, flush_events
+
+
+class EventCollectionMiddleware(object):
+    """Collect all events created while handling a request and write them in one batch when the response is done.
+    
+    The request user is attached to every event that is created without a user. Put this middleware after
+    `AuthenticationMiddleware` so that `request.user` is available.
+    """
+    
+    def process_request(self, request):
+        # this also writes anything left over from a request that never got to process_response
+        start_collecting(user=getattr(request, 'user', None))
+    
+    def process_response(self, request, response):
+        flush_events()
+        return response
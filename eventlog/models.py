@@ -1,25 +1,41 @@
 from datetime import datetime
+import threading
 import traceback
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
 
 from django.contrib.auth.models import User
 
 import jsonfield
 
+from eventlog.ids import generate_id, node_id
+
 import logging
 logger = logging.getLogger('eventlog')
 
+# with time-ordered IDs, events get their primary key in Python before they are saved. IDs sort by creation time,
+# so ordering and paging can use the primary key instead of the timestamp.
+TIME_ORDERED_IDS = getattr(settings, "EVENTLOG_TIME_ORDERED_IDS", False)
+if TIME_ORDERED_IDS:
+    # fail on startup rather than on the first event
+    node_id()
 
-class Event(models.Model):
-    """A simple event logging model."""
+# events collected by `start_collecting`, per thread
+_collected = threading.local()
+
+
+class BaseEvent(models.Model):
+    """The fields and behaviour of an event, with an auto-increment primary key."""
     
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
     level = models.IntegerField()
     label = models.CharField(max_length=50)
     message = models.TextField(null=True)
     
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, so that collected events keep the time they were created at instead of the time they were saved
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     extra = jsonfield.JSONField(null=True)
     
     def format(self):
@@ -28,7 +44,7 @@ class Event(models.Model):
             user = " (user: {0})".format(self.user.username) if self.user else "",
             message = self.message or "",
             extra=self.extra or "",
-            id=self.id,
+            id=self.id if self.id is not None else 0,
             messagespacer = " - " if (self.message or self.extra) else "",
             extraspacer = " " if (self.extra and self.message) else ""
         )
@@ -37,9 +53,25 @@ class Event(models.Model):
         return "{0} {1}".format(self.timestamp, self.format())
     
     class Meta:
+        abstract = True
         ordering = ["-timestamp"]
 
-def create_event(label, message=None, user=None, extra=None, level=logging.INFO, django_log=True):
+
+class TimeOrderedBaseEvent(BaseEvent):
+    """An event with a time-ordered primary key that is generated in Python."""
+    
+    id = models.BigIntegerField(primary_key=True, default=generate_id, editable=False)
+    
+    class Meta(BaseEvent.Meta):
+        abstract = True
+        ordering = ["-id"]
+
+
+class Event(TimeOrderedBaseEvent if TIME_ORDERED_IDS else BaseEvent):
+    """A simple event logging model."""
+
+
+def create_event(label, message=None, user=None, extra=None, level=logging.INFO, django_log=True, collect=True):
     """Create/log an event that has happened and attach the given information to it.
     
     label fills the `label` field in the model.
@@ -48,7 +80,17 @@ def create_event(label, message=None, user=None, extra=None, level=logging.INFO,
     extra fills the `extra` field in the model.
     level filles the `level` field in the model and determines the loglevel for the Django logging system if necessary
     django_log determines whether the event should be passed on to the regular Django logging stream
+    collect determines whether the event may be collected
+    
+    While events are being collected (see `start_collecting`), the event is not saved right away but on the next call
+    to `flush_events`, and the collecting user is used if no user is given. Events at level ERROR and above are
+    always saved right away, since something might be going wrong that keeps us from flushing.
+    Collected events are passed to the Django logging system right away, before they have an id, so unless time-ordered
+    IDs are used, their log lines show the id as 0000000000000000.
     """
+    collecting = getattr(_collected, 'events', None) is not None
+    if user is None and collecting:
+        user = _collected.user
     if user is not None and (type(user) == type(0) or type(user) == type(0L)):
         # we got a user_id instead of a user
         try:
@@ -59,7 +101,11 @@ def create_event(label, message=None, user=None, extra=None, level=logging.INFO,
     if user is not None and not user.is_authenticated():
         user = None
 
-    event = Event.objects.create(label=label, user=user, message=message, level=level, extra=extra)
+    if collecting and collect and level < logging.ERROR:
+        event = Event(label=label, user=user, message=message, level=level, extra=extra)
+        _collected.events.append(event)
+    else:
+        event = Event.objects.create(label=label, user=user, message=message, level=level, extra=extra)
     
     if django_log:
         logger.log(level, event.format())
@@ -67,6 +113,51 @@ def create_event(label, message=None, user=None, extra=None, level=logging.INFO,
     return event
 
 
+def start_collecting(user=None):
+    """Collect all events created in this thread in memory until `flush_events` is called.
+    
+    user is attached to every collected event that doesn't get a user of its own.
+    Events that were already being collected are written first, so that none of them get lost. Note that collecting
+    doesn't nest: the next call to `flush_events` ends collecting, and later events are saved right away again.
+    """
+    flush_events()
+    _collected.events = []
+    _collected.user = user
+
+
+def flush_events():
+    """Stop collecting events and write the collected events to the database in one batch.
+    
+    If the batch insert fails, the events are saved one by one instead. Returns the list of events.
+    Note that unless you use time-ordered IDs, the events will not have their `id` set after a batch insert.
+    """
+    events = getattr(_collected, 'events', None) or []
+    _collected.events = None
+    _collected.user = None
+    if not events:
+        return events
+    
+    # a failed insert leaves the transaction unusable on some databases (e.g. PostgreSQL), so every insert gets a
+    # savepoint we can roll back to
+    sid = transaction.savepoint()
+    try:
+        Event.objects.bulk_create(events)
+        transaction.savepoint_commit(sid)
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        logger.exception("Could not write {0} collected events in one batch, saving them one by one".format(len(events)))
+        for event in events:
+            sid = transaction.savepoint()
+            try:
+                event.save()
+                transaction.savepoint_commit(sid)
+            except Exception:
+                transaction.savepoint_rollback(sid)
+                logger.exception("Could not save event {0}".format(event.format()))
+    
+    return events
+
+
 def log_debug(label, message=None, user=None, extra=None, django_log=True):
     """Log an event at the debug level.
     
@@ -124,6 +215,7 @@ def log_exception(label, message=None, user=None, extra=None, exception=None, le
     if you are not in the catch block any more
     
     This will format the exception nicely, put it in extra['exception'] and log it as an event with given level.
+    The event is saved right away, even while events are being collected.
     """
     if extra is None:
         extra = {}
@@ -134,5 +226,5 @@ def log_exception(label, message=None, user=None, extra=None, exception=None, le
     exception = traceback.format_exc()
     extra['exception'] = exception
     
-    return create_event(label, message, user, extra, level, django_log)
+    return create_event(label, message, user, extra, level, django_log, collect=False)
     
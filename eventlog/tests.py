@@ -1,12 +1,31 @@
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.test.client import RequestFactory
+from django.utils import timezone
+from django.http import HttpResponse
 from django.contrib.auth.models import User
 
 from testfixtures import LogCapture
 
-from .models import Event
+from .models import Event, TimeOrderedBaseEvent
 from .models import create_event
 from .models import log_debug, log_info, log_event, log_warning, log_error, log_fatal
 from .models import log_exception
+from .models import start_collecting, flush_events
+from .middleware import EventCollectionMiddleware
+from . import archive as archive_module
+from .archive import archive_events, read_archive, read_index, write_archive_file
+from . import ids as ids_module
+from .ids import IdGenerator, id_to_datetime, datetime_to_id, EPOCH, MAX_SEQUENCE
 
 import logging
 logger = logging.getLogger()
@@ -345,5 +364,372 @@ class EventLogTesting(TestCase):
         self.assertIn('exception', event.extra)
 
 
+class EventCollectionTesting(TestCase):
+    
+    def setUp(self):
+        self.user = User.objects.create(username='johndoe', email='johndoe')
+        
+    def tearDown(self):
+        flush_events()
+        
+    def test_collect_and_flush(self):
+        """Test that collected events are only written when flushing."""
+        
+        start_collecting()
+        log_info("first")
+        log_warning("second", user=self.user)
+        self.assertEqual(Event.objects.count(), 0)
+        
+        events = flush_events()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(Event.objects.filter(user=self.user).count(), 1)
+        
+        # not collecting any more, events are written right away
+        log_info("third")
+        self.assertEqual(Event.objects.count(), 3)
+        
+    def test_errors_not_collected(self):
+        """Test that errors, fatal events and exceptions are saved right away while collecting."""
+        
+        start_collecting(user=self.user)
+        log_warning("warning", django_log=False)
+        log_error("error", django_log=False)
+        log_fatal("fatal", django_log=False)
+        try:
+            raise Exception()
+        except:
+            log_exception("exception", django_log=False)
+        self.assertEqual(sorted(Event.objects.values_list("label", flat=True)), ["error", "exception", "fatal"])
+        self.assertEqual(Event.objects.filter(user=self.user).count(), 3)
+        
+        flush_events()
+        self.assertEqual(Event.objects.count(), 4)
+        
+    def test_collected_timestamp(self):
+        """Test that collected events keep the time they were created at."""
+        
+        start_collecting()
+        event = log_info("label")
+        created = event.timestamp
+        time.sleep(0.01)
+        flush_events()
+        self.assertEqual(event.timestamp, created)
+        self.assertEqual(Event.objects.get(label="label").timestamp, created)
+        
+    def test_start_collecting_twice(self):
+        """Test that starting to collect again writes the events collected so far."""
+        
+        start_collecting(user=self.user)
+        log_info("first")
+        start_collecting()
+        self.assertEqual(Event.objects.get(label="first").user, self.user)
+        log_info("second")
+        self.assertEqual(Event.objects.count(), 1)
+        flush_events()
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertIsNone(Event.objects.get(label="second").user)
+        
+    def test_collecting_user(self):
+        """Test that the collecting user is attached to events without a user."""
+        
+        other = User.objects.create(username='janedoe', email='janedoe')
+        start_collecting(user=self.user)
+        log_info("mine")
+        log_info("theirs", user=other)
+        flush_events()
+        self.assertEqual(Event.objects.get(label="mine").user, self.user)
+        self.assertEqual(Event.objects.get(label="theirs").user, other)
+        
+    def test_flush_fallback(self):
+        """Test that events are saved one by one if the batch insert fails."""
+        
+        def broken_bulk_create(*args, **kwargs):
+            # fail in the database, like a real failed insert would
+            connection.cursor().execute("SELECT * FROM eventlog_no_such_table")
+        
+        rollbacks = []
+        def savepoint_rollback(sid, *args, **kwargs):
+            rollbacks.append(sid)
+            return original_rollback(sid, *args, **kwargs)
+        
+        start_collecting()
+        log_info("first")
+        log_info("second")
+        manager = Event.objects
+        original_bulk_create = manager.bulk_create
+        original_rollback = transaction.savepoint_rollback
+        manager.bulk_create = broken_bulk_create
+        transaction.savepoint_rollback = savepoint_rollback
+        try:
+            with LogCapture() as l:
+                events = flush_events()
+        finally:
+            manager.bulk_create = original_bulk_create
+            transaction.savepoint_rollback = original_rollback
+        # the failed batch was rolled back before saving the events one by one
+        self.assertEqual(len(rollbacks), 1)
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertTrue(all(event.id for event in events))
+        
+    def test_middleware(self):
+        """Test that the middleware collects the events of a request and attaches the request user."""
+        
+        middleware = EventCollectionMiddleware()
+        request = RequestFactory().get('/')
+        request.user = self.user
+        
+        middleware.process_request(request)
+        log_info("first")
+        log_info("second")
+        self.assertEqual(Event.objects.count(), 0)
+        response = HttpResponse()
+        self.assertIs(middleware.process_response(request, response), response)
+        self.assertEqual(Event.objects.filter(user=self.user).count(), 2)
+
+
+class ArchiveTesting(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for i in range(25):
+            log_info("LABEL_{0}".format(i // 10), message=str(i), django_log=False)
+        log_error("ERROR", django_log=False)
+        self.before = Event.objects.order_by("-timestamp")[0].timestamp + timedelta(seconds=1)
+        
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        
+    def test_archive_and_read(self):
+        """Test that archived events are removed from the database and can be read back."""
+        
+        ids = sorted(Event.objects.values_list("id", flat=True))
+        written = archive_events(self.before, directory=self.directory, segment_size=10)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(written[0][1], 26)
+        self.assertEqual(Event.objects.count(), 0)
+        
+        events = list(read_archive(directory=self.directory))
+        self.assertEqual(sorted(event.id for event in events), ids)
+        self.assertEqual(events[0].message, "0")
+        self.assertEqual(events[-1].level, logging.ERROR)
+        
+    def test_index(self):
+        """Test that every segment has an index entry with labels and level counts."""
+        
+        path, count = archive_events(self.before, directory=self.directory, segment_size=10)[0]
+        index = read_index(path)
+        self.assertEqual([segment['count'] for segment in index], [10, 10, 6])
+        self.assertEqual(index[0]['labels'], ["LABEL_0"])
+        self.assertEqual(index[2]['labels'], ["ERROR", "LABEL_2"])
+        self.assertEqual(index[2]['levels'], {logging.INFO: 5, logging.ERROR: 1})
+        self.assertTrue(index[0]['start'] <= index[0]['end'] <= index[1]['start'])
+        
+    def test_read_by_label_and_time(self):
+        """Test that archived events can be filtered by label and time range."""
+        
+        archive_events(self.before, directory=self.directory, segment_size=10)
+        events = list(read_archive(labels=["LABEL_1", "ERROR"], directory=self.directory))
+        self.assertEqual(len(events), 11)
+        self.assertTrue(all(event.label in ("LABEL_1", "ERROR") for event in events))
+        
+        self.assertEqual(list(read_archive(end=events[0].timestamp - timedelta(days=1), directory=self.directory)), [])
+        self.assertEqual(len(list(read_archive(start=self.before - timedelta(days=1), directory=self.directory))), 26)
+        
+    def test_archive_many_events(self):
+        """Test that more events than fit into one delete query are archived and deleted."""
+        
+        Event.objects.bulk_create([Event(label="BULK", level=logging.INFO) for i in range(1200)])
+        before = Event.objects.order_by("-timestamp")[0].timestamp + timedelta(seconds=1)
+        written = archive_events(before, directory=self.directory)
+        self.assertEqual(sum(count for path, count in written), 1226)
+        self.assertEqual(Event.objects.count(), 0)
+        
+    def test_deleted_user(self):
+        """Test that archived events of users that have been deleted since have no user."""
+        
+        user = User.objects.create(username='johndoe', email='johndoe')
+        other = User.objects.create(username='janedoe', email='janedoe')
+        log_info("USER", user=user, django_log=False)
+        log_info("USER", user=other, django_log=False)
+        archive_events(self.before + timedelta(seconds=1), directory=self.directory)
+        user.delete()
+        
+        events = list(read_archive(labels=["USER"], directory=self.directory))
+        self.assertEqual([event.user for event in events], [None, other])
+        self.assertEqual(events[0].format(), "{0:016} USER".format(events[0].id))
+        
+    def test_archive_twice(self):
+        """Test that archiving a month again adds the events to the month's file."""
+        
+        middle = Event.objects.order_by("timestamp", "id")[10].timestamp
+        first_path, first_count = archive_events(middle, directory=self.directory, segment_size=10)[0]
+        second_path, second_count = archive_events(self.before, directory=self.directory, segment_size=10)[0]
+        self.assertEqual(first_path, second_path)
+        self.assertEqual(first_count + second_count, 26)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(first_path)])
+        self.assertEqual(sum(segment['count'] for segment in read_index(first_path)), 26)
+        events = list(read_archive(directory=self.directory))
+        self.assertEqual([event.message for event in events[:25]], [str(i) for i in range(25)])
+        
+    def test_failed_write(self):
+        """Test that no temporary file is left behind if writing an archive file fails."""
+        
+        def broken_events():
+            yield Event.objects.all()[0]
+            raise Exception("database went away")
+        
+        path = os.path.join(self.directory, "events.archive")
+        self.assertRaises(Exception, write_archive_file, path, broken_events())
+        self.assertEqual(os.listdir(self.directory), [])
+        
+    def test_failed_delete(self):
+        """Test that events are not archived twice if deleting them failed."""
+        
+        def broken_delete(ids):
+            raise Exception("could not delete")
+        
+        original = archive_module._delete_events
+        archive_module._delete_events = broken_delete
+        try:
+            self.assertRaises(Exception, archive_events, self.before, directory=self.directory)
+        finally:
+            archive_module._delete_events = original
+        self.assertEqual(Event.objects.count(), 26)
+        
+        self.assertEqual(archive_events(self.before, directory=self.directory), [])
+        self.assertEqual(Event.objects.count(), 0)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        events = list(read_archive(directory=self.directory))
+        self.assertEqual(len(events), 26)
+        self.assertEqual(len(set(event.id for event in events)), 26)
+        
+    def test_keep_newer_events(self):
+        """Test that events newer than the cutoff stay in the database."""
+        
+        written = archive_events(Event.objects.order_by("timestamp")[0].timestamp, directory=self.directory)
+        self.assertEqual(written, [])
+        self.assertEqual(Event.objects.count(), 26)
+        self.assertEqual(os.listdir(self.directory), [])
+        
+    def test_command(self):
+        """Test the eventlog_archive management command."""
+        
+        call_command("eventlog_archive", days=1, directory=self.directory)
+        self.assertEqual(Event.objects.count(), 26)
+        call_command("eventlog_archive", days=0, directory=self.directory)
+        self.assertEqual(Event.objects.count(), 0)
+        self.assertEqual(len(list(read_archive(directory=self.directory))), 26)
+
+
+class IdGeneratorTesting(TestCase):
+    """Test the time-ordered ID generator."""
+    
+    def test_ids_are_ordered(self):
+        """Test that IDs grow with time and within the same millisecond."""
+        
+        clock = iter([EPOCH + 5, EPOCH + 5, EPOCH + 6]).next
+        generator = IdGenerator(node=3, clock=clock)
+        ids = [generator.next_id() for i in range(3)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 3)
+        
+    def test_clock_going_backwards(self):
+        """Test that IDs stay ordered if the clock goes backwards."""
+        
+        clock = iter([EPOCH + 10, EPOCH + 9]).next
+        generator = IdGenerator(node=0, clock=clock)
+        first, second = generator.next_id(), generator.next_id()
+        self.assertTrue(second > first)
+        
+    def test_sequence_overflow(self):
+        """Test that the generator waits for the next millisecond when the sequence is exhausted."""
+        
+        times = [EPOCH] * (MAX_SEQUENCE + 2) + [EPOCH + 1] * (MAX_SEQUENCE + 2)
+        generator = IdGenerator(node=0, clock=iter(times).next)
+        ids = [generator.next_id() for i in range(MAX_SEQUENCE + 2)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(id_to_datetime(ids[-1]), id_to_datetime(ids[0]) + timedelta(milliseconds=1))
+        
+    def test_different_nodes_dont_collide(self):
+        """Test that generators with different node ids never generate the same IDs."""
+        
+        first = IdGenerator(node=1, clock=lambda: EPOCH)
+        second = IdGenerator(node=2, clock=lambda: EPOCH)
+        first_ids = set(first.next_id() for i in range(100))
+        second_ids = set(second.next_id() for i in range(100))
+        self.assertEqual(first_ids & second_ids, set())
+        
+    @override_settings(EVENTLOG_NODE_ID=None)
+    def test_node_id_required(self):
+        """Test that time-ordered IDs can't be generated without EVENTLOG_NODE_ID."""
+        
+        original = ids_module._generator
+        ids_module._generator = None
+        try:
+            self.assertRaises(ImproperlyConfigured, ids_module.generate_id)
+        finally:
+            ids_module._generator = original
+        
+    def test_bad_node(self):
+        """Test that node numbers outside of 10 bits are rejected."""
+        
+        self.assertRaises(ValueError, IdGenerator, node=1024)
+        
+    def test_datetime_roundtrip(self):
+        """Test that IDs can be converted to datetimes and back for range queries."""
+        
+        dt = datetime(2013, 2, 1, 12, 30, 15, 123000)
+        event_id = datetime_to_id(dt)
+        self.assertEqual(id_to_datetime(event_id), dt)
+        generator = IdGenerator(node=1023, clock=lambda: 1359721815123)
+        self.assertTrue(datetime_to_id(dt) <= generator.next_id() < datetime_to_id(dt + timedelta(milliseconds=1)))
+
+
+class TimeOrderedEvent(TimeOrderedBaseEvent):
+    """An event with time-ordered IDs, so we can test them whatever EVENTLOG_TIME_ORDERED_IDS is set to."""
+    
+    class Meta(TimeOrderedBaseEvent.Meta):
+        app_label = "eventlog"
 
 
+@override_settings(EVENTLOG_NODE_ID=1)
+class TimeOrderedEventTesting(TestCase):
+    
+    def setUp(self):
+        # start a new generator, with the node id from our settings
+        self.original_generator = ids_module._generator
+        ids_module._generator = None
+    
+    def tearDown(self):
+        ids_module._generator = self.original_generator
+    
+    def test_event_ordering(self):
+        """Test that events come out newest first, whatever EVENTLOG_TIME_ORDERED_IDS is set to."""
+        
+        now = timezone.now()
+        events = [Event.objects.create(label="label {0}".format(i), level=logging.INFO, timestamp=now + timedelta(seconds=i))
+                  for i in range(5)]
+        self.assertEqual([event.label for event in Event.objects.all()], [event.label for event in reversed(events)])
+    
+    def test_id_before_save(self):
+        """Test that events have their ID before they are saved, and keep it."""
+        
+        event = TimeOrderedEvent(label="label", level=logging.INFO)
+        event_id = event.id
+        self.assertTrue(event_id)
+        event.save()
+        self.assertEqual(TimeOrderedEvent.objects.get(label="label").id, event_id)
+        
+    def test_bulk_create(self):
+        """Test that bulk inserted events keep their IDs and are ordered by them."""
+        
+        events = [TimeOrderedEvent(label="label {0}".format(i), level=logging.INFO) for i in range(5)]
+        event_ids = [event.id for event in events]
+        TimeOrderedEvent.objects.bulk_create(events)
+        self.assertEqual([event.id for event in events], event_ids)
+        # the default ordering is by id, newest first
+        self.assertEqual([event.label for event in TimeOrderedEvent.objects.all()],
+                         ["label {0}".format(i) for i in reversed(range(5))])
+        self.assertEqual(list(TimeOrderedEvent.objects.values_list("id", flat=True)), sorted(event_ids, reverse=True))